@@ -1,3 +1,4 @@
+import logging
 import os
 import re
 from typing import Optional
@@ -10,6 +11,9 @@ from role_core import (chat_progress, init_all_remote_actors,
                        start_chat_with_topic)
 from story_holder import get_avatar_by_name, get_story_by_id, stories
 
+logging.basicConfig(level=os.getenv('LOGLEVEL', 'INFO').upper())
+logger = logging.getLogger(__name__)
+
 chat_history = []
 RayTaskExecutor.init_ray()
 
@@ -238,7 +242,7 @@ with demo:
         use_init = True
 
         for frame_text in chat_progress(None, _state):
-            print(frame_text)
+            logger.debug('frame: %s', frame_text)
             role, content = get_frame_data(frame_text)
             if role in bot_messages:
                 bot_messages[role] += content
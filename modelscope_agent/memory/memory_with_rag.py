@@ -4,7 +4,6 @@ from typing import Dict, Iterator, List, Optional, Union
 import json
 from modelscope_agent.agent import Agent
 from modelscope_agent.llm.base import BaseChatModel
-from modelscope_agent.rag.knowledge import BaseKnowledge
 from modelscope_agent.storage import KnowledgeVector
 from modelscope_agent.utils.logger import agent_logger as logger
 
@@ -30,6 +29,9 @@ class MemoryWithRag(Memory, Agent):
             name=name,
             description=description)
 
+        # llama_index is imported on first use, importing `modelscope_agent.memory` stays cheap
+        from modelscope_agent.rag.knowledge import BaseKnowledge
+
         # allow vector storage to save knowledge
         self.store_knowledge = BaseKnowledge(
             urls,
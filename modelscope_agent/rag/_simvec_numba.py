@@ -0,0 +1,75 @@
+"""Optional numba kernels used by `NumpyVectorStore` to score embeddings.
+
+numba is not a requirement of modelscope-agent, when it can not be imported `NUMBA_AVAILABLE` is False
+and the store keeps scoring with plain numpy.
+"""
+from typing import Tuple
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+NUMBA_AVAILABLE = njit is not None
+
+if NUMBA_AVAILABLE:
+
+    # serial on purpose: queries run in request threads, and numba's default workqueue threading layer
+    # aborts the process when two threads enter a parallel kernel. Filtered row sets are small anyway.
+    @njit(fastmath=True, cache=True)
+    def _dot_rows(query, matrix, rows, out):
+        for i in range(rows.shape[0]):
+            row = rows[i]
+            acc = np.float32(0.0)
+            for j in range(query.shape[0]):
+                acc += matrix[row, j] * query[j]
+            out[i] = acc
+
+    @njit(fastmath=True, cache=True)
+    def _dot_rows_int8(query, codes, scales, rows, out):
+        for i in range(rows.shape[0]):
+            row = rows[i]
+            acc = np.float32(0.0)
+            for j in range(query.shape[0]):
+                acc += np.float32(codes[row, j]) * query[j]
+            out[i] = acc * scales[row]
+
+
+def cosine_scores(query: np.ndarray, matrix: np.ndarray,
+                  rows: np.ndarray) -> np.ndarray:
+    """Dot products of a normalized query with the given rows of a normalized float32 matrix.
+
+    The rows are read in place, unlike `matrix[rows] @ query` which first copies every selected row.
+    """
+    out = np.empty(len(rows), dtype=np.float32)
+    _dot_rows(
+        np.ascontiguousarray(query, dtype=np.float32),
+        np.ascontiguousarray(matrix),
+        np.ascontiguousarray(rows, dtype=np.int64), out)
+    return out
+
+
+def cosine_scores_int8(query: np.ndarray, codes: np.ndarray,
+                       scales: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Like `cosine_scores` for int8 codes with one scale per row.
+
+    The codes are widened one element at a time, no float32 copy of the matrix is made.
+    """
+    out = np.empty(len(rows), dtype=np.float32)
+    _dot_rows_int8(
+        np.ascontiguousarray(query, dtype=np.float32),
+        np.ascontiguousarray(codes), np.ascontiguousarray(scales),
+        np.ascontiguousarray(rows, dtype=np.int64), out)
+    return out
+
+
+def topk(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions and values of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return top, scores[top]
@@ -1,10 +1,15 @@
+import asyncio
 import os
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from functools import lru_cache
 from http import HTTPStatus
 from typing import Any, List, Optional
 
 import dashscope
+import httpx
+from dashscope.common.api_key import get_default_api_key
 from llama_index.legacy.bridge.pydantic import Field
 from llama_index.legacy.callbacks import CallbackManager
 from llama_index.legacy.core.embeddings.base import (DEFAULT_EMBED_BATCH_SIZE,
@@ -16,6 +21,30 @@ DashscopeModelName = [
     'text-embedding-v2',
 ]
 
+# dashscope text embedding api accepts at most 25 texts per request
+DASHSCOPE_MAX_BATCH_SIZE = 25
+
+# blocking embedding requests issued from async code run here, which bounds the requests in flight
+_EMBED_MAX_WORKERS = 8
+_EMBED_EXECUTOR = ThreadPoolExecutor(max_workers=_EMBED_MAX_WORKERS)
+
+DASHSCOPE_EMBEDDING_PATH = '/services/embeddings/text-embedding/text-embedding'
+
+
+@lru_cache(maxsize=1)
+def _get_http_client() -> httpx.Client:
+    # one pooled client per process, embedding requests reuse its connections instead of a new TLS
+    # session each. httpx clients are thread safe, the executor threads share it.
+    try:
+        import h2  # noqa F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    return httpx.Client(
+        http2=http2,
+        timeout=30,
+        limits=httpx.Limits(max_keepalive_connections=_EMBED_MAX_WORKERS))
+
 
 # Assuming BaseEmbedding is a Pydantic model and handles its own initializations
 class Embedding(BaseEmbedding):
@@ -33,7 +62,9 @@ class Embedding(BaseEmbedding):
 
     async def _aget_query_embedding(self, query: str) -> List[float]:
         """Get query embedding async."""
-        return self._get_query_embedding(query)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_EMBED_EXECUTOR,
+                                          self._get_query_embedding, query)
 
     def _get_text_embedding(self, text: str) -> List[float]:
         """Get text embedding."""
@@ -41,19 +72,33 @@ class Embedding(BaseEmbedding):
 
     async def _aget_text_embedding(self, text: str) -> List[float]:
         """Get text embedding async."""
-        return self._get_text_embedding(text)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_EMBED_EXECUTOR,
+                                          self._get_text_embedding, text)
 
     def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
         """Get text embeddings."""
         return self._embed(texts, text_type='document')
 
+    async def _aget_text_embeddings(self,
+                                    texts: List[str]) -> List[List[float]]:
+        """Get text embeddings async without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_EMBED_EXECUTOR,
+                                          self._get_text_embeddings, texts)
+
 
 class DashscopeEmbedding(Embedding):
     """DashscopeEmbedding uses the dashscope API to generate embeddings for text."""
 
+    workspace: Optional[str] = Field(
+        default=None, description='The dashscope workspace id.')
+
     def __init__(
         self,
         model_name: str = 'text-embedding-v2',
+        embed_batch_size: int = DASHSCOPE_MAX_BATCH_SIZE,
+        workspace: Optional[str] = None,
     ):
         """
         A class representation for generating embeddings using the dashscope API.
@@ -61,33 +106,63 @@ class DashscopeEmbedding(Embedding):
         Args:
             model_name (str): The name of the model to be used for generating embeddings. The class ensures that
                           this model is supported and that the input type provided is compatible with the model.
+            embed_batch_size (int): The number of texts embedded per batch. Batches larger than what the api
+                          accepts are split into several requests.
+            workspace (str): The dashscope workspace id sent with every request, defaults to the
+                          `DASHSCOPE_WORKSPACE_ID` environment variable.
         """
 
         # Validate model_name and input_type
         if model_name not in DashscopeModelName:
             raise ValueError(f'model {model_name} is not supported.')
 
-        super().__init__(model_name=model_name)
+        super().__init__(
+            model_name=model_name,
+            embed_batch_size=embed_batch_size,
+            workspace=workspace or os.environ.get('DASHSCOPE_WORKSPACE_ID'))
 
     @classmethod
     def class_name(cls) -> str:
         return 'DashscopeEmbedding'
 
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Get text embeddings, at most `DASHSCOPE_MAX_BATCH_SIZE` texts per request."""
+        embeddings = []
+        for i in range(0, len(texts), DASHSCOPE_MAX_BATCH_SIZE):
+            embeddings.extend(
+                self._embed(
+                    texts[i:i + DASHSCOPE_MAX_BATCH_SIZE],
+                    text_type='document'))
+        return embeddings
+
     def _embed(self,
                texts: List[str],
                text_type='document') -> List[List[float]]:
         """Embed sentences using dashscope."""
-        assert os.environ.get(
-            'DASHSCOPE_API_KEY',
-            None), 'DASHSCOPE_API_KEY should be set in environ.'
-        resp = dashscope.TextEmbedding.call(
-            input=texts,
-            model=self.model_name,
-            text_type=text_type,
-        )
+        # the environment is read again since it may be set after dashscope is imported, the sdk helper
+        # then falls back to the api key file, e.g. ~/.dashscope/api_key
+        api_key = dashscope.api_key or os.environ.get(
+            'DASHSCOPE_API_KEY') or get_default_api_key()
+        headers = {'Authorization': f'Bearer {api_key}'}
+        if self.workspace:
+            headers['X-DashScope-WorkSpace'] = self.workspace
+        resp = _get_http_client().post(
+            dashscope.base_http_api_url.rstrip('/') + DASHSCOPE_EMBEDDING_PATH,
+            headers=headers,
+            json={
+                'model': self.model_name,
+                'input': {
+                    'texts': texts
+                },
+                'parameters': {
+                    'text_type': text_type
+                },
+            })
         if resp.status_code == HTTPStatus.OK:
-            res = resp.output['embeddings']
+            res = sorted(
+                resp.json()['output']['embeddings'],
+                key=lambda e: e['text_index'])
         else:
-            raise ValueError(f'call dashscope api failed: {resp}')
+            raise ValueError(f'call dashscope api failed: {resp.text}')
 
         return [list(map(float, e['embedding'])) for e in res]
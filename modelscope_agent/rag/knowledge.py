@@ -1,29 +1,88 @@
+import copy
 import os
+import threading
+from collections import defaultdict
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Type, Union
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
 import fsspec
-from llama_index.core import SimpleDirectoryReader, VectorStoreIndex
+from llama_index.core import (SimpleDirectoryReader, StorageContext,
+                              VectorStoreIndex, load_index_from_storage)
 from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.ingestion import IngestionPipeline
 from llama_index.core.llama_pack.base import BaseLlamaPack
 from llama_index.core.llms.llm import LLM
+from llama_index.core.node_parser import SentenceSplitter, TextSplitter
 from llama_index.core.postprocessor.types import BaseNodePostprocessor
 from llama_index.core.query_engine import BaseQueryEngine, RetrieverQueryEngine
 from llama_index.core.readers.base import BaseReader
-from llama_index.core.schema import (Document, MetadataMode, QueryBundle,
-                                     TransformComponent)
+from llama_index.core.schema import (BaseNode, Document, MetadataMode,
+                                     QueryBundle, TransformComponent)
 from llama_index.core.settings import Settings
-from llama_index.core.vector_stores.types import (MetadataFilter,
+from llama_index.core.vector_stores.types import (FilterCondition,
+                                                  MetadataFilter,
                                                   MetadataFilters)
 from llama_index.legacy.core.embeddings.base import BaseEmbedding
 from modelscope_agent.llm import get_chat_model
 from modelscope_agent.llm.base import BaseChatModel
 from modelscope_agent.rag.emb import DashscopeEmbedding
 from modelscope_agent.rag.llm import ModelscopeAgentLLM
+from modelscope_agent.rag.manifest import (file_entry, is_unchanged,
+                                           load_manifest, save_manifest)
+from modelscope_agent.rag.vector_store import NumpyVectorStore
 from modelscope_agent.utils.nltk_utils import install_nltk_data
 
 install_nltk_data()
 
+LOAD_DOCUMENTS_NUM_WORKERS = 'LOAD_DOCUMENTS_NUM_WORKERS'
+
+
+@lru_cache(maxsize=1)
+def _get_default_readers() -> Dict[str, BaseReader]:
+    # lazy import, only resolved once per process
+    try:
+        from llama_index.readers.file import (PandasCSVReader, HTMLTagReader,
+                                              FlatReader)
+    except ImportError:
+        print(
+            '`llama-index-readers-file` package not found. Can not read .pd .html .txt file.'
+        )
+        return {}
+
+    return {
+        '.pb': PandasCSVReader(),
+        '.html': HTMLTagReader(),
+        '.txt': FlatReader()
+    }
+
+
+@lru_cache(maxsize=128)
+def _get_file_filters(file_names: Tuple[str, ...]) -> MetadataFilters:
+    filters = [
+        MetadataFilter(key='file_name', value=file_name)
+        for file_name in file_names
+    ]
+    # a node belongs to a single file, the filters only match when any of them does
+    return MetadataFilters(filters=filters, condition=FilterCondition.OR)
+
+
+def _enumerate(path: str, recursive: bool, exclude_hidden: bool) -> List[str]:
+    # a single os.scandir walk, its entries already know whether they are files or directories
+    files = []
+    dirs = [path]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if exclude_hidden and entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    if recursive:
+                        dirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.path)
+    return sorted(files)
+
 
 @dataclass
 class FileQueryBundle(QueryBundle):
@@ -49,10 +108,18 @@ class BaseKnowledge(BaseLlamaPack):
             `.jpg`, `.png`, `.jpeg`, `.mp3`, `.mp4`, `.csv`, `.epub`, `.md`, `.mbox`, `.ipynb`, `txt`, `.pd`,
             `.html`.
         transformations: The chunk or split strategies. It should be a subclass of llama-index TransformComponent.
-            The default is SentenceSplitter.
+            The default is SentenceSplitter, its `chunk_size` (512 by default) and `chunk_overlap` can be set
+            through kwargs.
         post_processors: The processors of retrieved contents, such of re-rank. The default is None.
+        use_cache: Whether to load the index cached in `cache_dir`, defaults to True. Only the files that are new
+            or changed since they were cached are read again, according to `manifest.json` in `cache_dir`.
+        quantization: How embeddings of a new index are stored, None for float32 or `int8` for a quarter of the
+            memory and disk size. A cached index keeps the format it was built with.
     """
 
+    _default_llm: Optional[LLM] = None
+    _default_llm_lock = threading.Lock()
+
     def __init__(self,
                  files: Union[List, str] = [],
                  cache_dir: str = './run',
@@ -63,9 +130,11 @@ class BaseKnowledge(BaseLlamaPack):
                  transformations: List[Type[TransformComponent]] = [],
                  post_processors: List[Type[BaseNodePostprocessor]] = [],
                  use_cache: bool = True,
+                 quantization: Optional[str] = None,
                  **kwargs) -> None:
         self.retriever_cls = retriever
         self.cache_dir = cache_dir
+        self.quantization = quantization
         # self.register_files(files) # TODO: file manager
         self.extra_readers = self.get_extra_readers(loaders)
         self.embed_model = self.get_emb_model(emb)
@@ -78,13 +147,18 @@ class BaseKnowledge(BaseLlamaPack):
         Settings._llm = self.llm
 
         # 可对本召回器的文本范围 进行过滤、筛选、rechunk。transformations为空时，默认按语义rechunk。
-        self.transformations = self.get_transformations(transformations)
+        self.transformations = self.get_transformations(
+            transformations, **kwargs)
 
         self.postprocessors = self.get_postprocessors(post_processors,
                                                       **kwargs)
 
+        # the live index, reused by `add` to insert new documents in place
+        self._index = None
+        self._dirty = False
+        self._cached = False
         root_retriever = self.get_root_retriever(
-            documents, use_cache=use_cache, **kwargs)
+            documents, use_cache=use_cache, files=files, **kwargs)
 
         self.query_engine = None
         if root_retriever:
@@ -111,11 +185,24 @@ class BaseKnowledge(BaseLlamaPack):
             )
 
         if not llama_index_llm:
-            llm_config = {'model': 'qwen-max', 'model_server': 'dashscope'}
-            ms_agent_llm = get_chat_model(**llm_config)
-            llama_index_llm = ModelscopeAgentLLM(ms_agent_llm)
+            llama_index_llm = self.get_default_llm()
         return llama_index_llm
 
+    @classmethod
+    def get_default_llm(cls) -> LLM:
+        # built once and shared by every knowledge base created without an llm
+        if BaseKnowledge._default_llm is None:
+            with BaseKnowledge._default_llm_lock:
+                if BaseKnowledge._default_llm is None:
+                    llm_config = {
+                        'model': 'qwen-max',
+                        'model_server': 'dashscope'
+                    }
+                    ms_agent_llm = get_chat_model(**llm_config)
+                    BaseKnowledge._default_llm = ModelscopeAgentLLM(
+                        ms_agent_llm)
+        return BaseKnowledge._default_llm
+
     def get_emb_model(self,
                       emb_cls: Optional[Type[BaseEmbedding]]) -> BaseEmbedding:
         emb_model = None
@@ -150,6 +237,12 @@ class BaseKnowledge(BaseLlamaPack):
                 print(
                     f'node parser {t_cls} cannot be used and it will be ignored. Detail: {e}'
                 )
+        if not res:
+            # 可配置chunk_size等, on this splitter rather than the global llama-index Settings
+            splitter_kwargs = {'chunk_size': kwargs.get('chunk_size', 512)}
+            if 'chunk_overlap' in kwargs:
+                splitter_kwargs['chunk_overlap'] = kwargs['chunk_overlap']
+            res.append(SentenceSplitter(**splitter_kwargs))
         return res
 
     def get_postprocessors(
@@ -171,20 +264,20 @@ class BaseKnowledge(BaseLlamaPack):
     def get_root_retriever(self,
                            documents: List[Document],
                            use_cache: bool = True,
+                           files: Union[List, str] = [],
                            **kwargs) -> BaseRetriever:
 
         # indexing
-        # 可配置chunk_size等
-        Settings.chunk_size = 512
         index = None
         if use_cache:
             if self.cache_dir is not None and os.path.exists(self.cache_dir):
                 try:
                     # Load from cache
-                    from llama_index.core import StorageContext, load_index_from_storage
-                    # rebuild storage context
+                    # rebuild storage context, embeddings are memory mapped instead of parsed from json
                     storage_context = StorageContext.from_defaults(
-                        persist_dir=self.cache_dir)
+                        persist_dir=self.cache_dir,
+                        vector_store=NumpyVectorStore.from_persist_dir(
+                            self.cache_dir))
                     # load index
 
                     index = load_index_from_storage(
@@ -194,22 +287,151 @@ class BaseKnowledge(BaseLlamaPack):
                         f'Can not load index from cache_dir {self.cache_dir}, detail: {e}'
                     )
 
+        # source file -> signature and document ids, lets a cached index only re-read changed files
+        self._manifest = {}
+        # whether the index differs from the cache, a warm start with nothing new rewrites nothing
+        self._dirty = False
+        # whether `cache_dir` holds this index, the manifest is only saved next to it
+        self._cached = index is not None
+        if index is not None:
+            self._manifest = load_manifest(self.cache_dir)
+            if self._manifest is None:
+                # cache written before manifests, trust it like it used to be
+                self._manifest = self._manifest_from_index(index)
+        if use_cache and files:
+            documents = self._read_changed_files(index, files)
+
         if documents is not None:
             if not index:
-                index = VectorStoreIndex.from_documents(
-                    documents=documents,
+                storage_context = StorageContext.from_defaults(
+                    vector_store=NumpyVectorStore(
+                        quantization=self.quantization))
+                index = VectorStoreIndex(
+                    self._get_nodes(documents),
+                    storage_context=storage_context,
                     transformations=self.transformations,
                     embed_model=self.embed_model)
-            else:
                 for doc in documents:
-                    index.insert(doc)
-        if not index:
+                    index.docstore.set_document_hash(doc.get_doc_id(),
+                                                     doc.hash)
+                # an empty index is kept in memory for `add`, but never replaces a cache
+                self._dirty = bool(documents)
+            else:
+                self._insert_documents(index, documents)
+        if index is None:
             print('Neither documents nor cache_dir.')
             return None
 
-        if self.cache_dir is not None:
+        if documents:
+            self._record_files(index, documents)
+        self._persist(index)
+
+        self._index = index
+        return self.get_retriever(index)
+
+    def _read_changed_files(
+            self, index: Optional[VectorStoreIndex],
+            files: Union[List, str]) -> Optional[List[Document]]:
+        """Read the files that are new or changed since they were indexed, None if there is none.
+
+        Documents of changed files, and of indexed files that no longer exist, are deleted from the index.
+        """
+        manifest = self._manifest
+        stale_paths = [path for path in manifest if not os.path.exists(path)]
+        changed_paths = []
+        for path in self.get_input_files(files):
+            entry = manifest.get(path)
+            if entry is None or not is_unchanged(path, entry):
+                changed_paths.append(path)
+                if entry is not None:
+                    stale_paths.append(path)
+        for path in stale_paths:
+            for doc_id in manifest.pop(path)['doc_ids']:
+                index.delete_ref_doc(doc_id, delete_from_docstore=True)
+                self._dirty = True
+
+        if not changed_paths:
+            return None
+        return self.read(changed_paths)
+
+    def _manifest_from_index(
+            self, index: VectorStoreIndex) -> Dict[str, Dict[str, Any]]:
+        doc_ids = defaultdict(list)
+        ref_doc_info = index.docstore.get_all_ref_doc_info() or {}
+        for doc_id, info in ref_doc_info.items():
+            file_path = info.metadata.get('file_path')
+            if file_path:
+                doc_ids[os.path.abspath(file_path)].append(doc_id)
+        return {
+            path: file_entry(path, ids)
+            for path, ids in doc_ids.items() if os.path.isfile(path)
+        }
+
+    def _record_files(self, index: VectorStoreIndex,
+                      documents: List[Document]) -> None:
+        # a document skipped by `_insert_documents` was never indexed, record the one with its hash instead
+        hash_to_doc_id = index.docstore.get_all_document_hashes()
+        doc_ids = defaultdict(list)
+        for doc in documents:
+            file_path = doc.metadata.get('file_path')
+            if not file_path:
+                continue
+            doc_id = doc.get_doc_id()
+            if index.docstore.get_document_hash(doc_id) is None:
+                doc_id = hash_to_doc_id.get(doc.hash, doc_id)
+            ids = doc_ids[os.path.abspath(file_path)]
+            if doc_id not in ids:
+                ids.append(doc_id)
+        for path, ids in doc_ids.items():
+            if os.path.isfile(path):
+                self._manifest[path] = file_entry(path, ids)
+
+    def _get_nodes(self, documents: List[Document]) -> List[BaseNode]:
+        # split in this process unless workers are opted in, see `get_num_workers`. Spawning workers that
+        # each import llama-index costs more than splitting a few pages. Other transformations may hold an
+        # llm or a client that can not be sent to another process.
+        num_workers = 1
+        if all(isinstance(t, TextSplitter) for t in self.transformations):
+            num_workers = self.get_num_workers(len(documents))
+        pipeline = IngestionPipeline(
+            transformations=self.transformations, disable_cache=True)
+        return pipeline.run(documents=documents, num_workers=num_workers)
+
+    def _insert_documents(self,
+                          index: VectorStoreIndex,
+                          documents: List[Document],
+                          batch_size: Optional[int] = None) -> None:
+        # documents already indexed are not embedded again
+        seen_hashes = set(index.docstore.get_all_document_hashes())
+        new_documents = []
+        for doc in documents:
+            if doc.hash not in seen_hashes:
+                seen_hashes.add(doc.hash)
+                new_documents.append(doc)
+        documents = new_documents
+
+        # split every document first, so the nodes are embedded in batches instead of one request per document
+        nodes = self._get_nodes(documents)
+        batch_size = batch_size or max(1, len(nodes))
+        for start in range(0, len(nodes), batch_size):
+            index.insert_nodes(nodes[start:start + batch_size])
+            self._dirty = True
+        for doc in documents:
+            index.docstore.set_document_hash(doc.get_doc_id(), doc.hash)
+
+    def _persist(self, index: VectorStoreIndex) -> None:
+        if self.cache_dir is None:
+            return
+        if self._dirty:
             index.storage_context.persist(persist_dir=self.cache_dir)
-
+            self._dirty = False
+            self._cached = True
+        # small, and may change without the index changing, e.g. when a file is only touched. An index that
+        # was neither loaded nor persisted must not overwrite the manifest of the one in `cache_dir`.
+        if self._cached:
+            save_manifest(self.cache_dir, self._manifest)
+
+    def get_retriever(self, index: VectorStoreIndex) -> BaseRetriever:
         # init retriever tool
         if self.retriever_cls:
             try:
@@ -228,6 +450,7 @@ class BaseKnowledge(BaseLlamaPack):
         for file_type, loader_or_cls in loaders.items():
             if isinstance(loader_or_cls, BaseReader):
                 extra_readers[file_type] = loader_or_cls
+                continue
             try:
                 loader = loader_or_cls()
                 extra_readers[file_type] = loader
@@ -236,21 +459,27 @@ class BaseKnowledge(BaseLlamaPack):
                     f'Using {loader_or_cls} failed. Can not read {file_type} file. Detail: {e}'
                 )
 
-        # lazy import
-        try:
-            from llama_index.readers.file import (PandasCSVReader,
-                                                  HTMLTagReader, FlatReader)
-        except ImportError:
-            print(
-                '`llama-index-readers-file` package not found. Can not read .pd .html .txt file.'
-            )
-            return extra_readers
-
-        return {
-            '.pb': PandasCSVReader(),
-            '.html': HTMLTagReader(),
-            '.txt': FlatReader()
-        }.update(extra_readers)
+        # user loaders take precedence over the default ones
+        readers = dict(_get_default_readers())
+        readers.update(extra_readers)
+        return readers
+
+    def get_input_files(self,
+                        knowledge_source: Union[str, List[str]],
+                        exclude_hidden: bool = True,
+                        recursive: bool = False) -> List[str]:
+        """Absolute paths of the files `read` would load from the knowledge source."""
+        if isinstance(knowledge_source, str):
+            if os.path.isdir(knowledge_source):
+                return [
+                    os.path.abspath(file) for file in _enumerate(
+                        knowledge_source, recursive, exclude_hidden)
+                ]
+            knowledge_source = [knowledge_source]
+        return [
+            os.path.abspath(str(file)) for file in knowledge_source
+            if os.path.isfile(file)
+        ]
 
     def read(self,
              knowledge_source: Union[str, List[str]],
@@ -260,46 +489,64 @@ class BaseKnowledge(BaseLlamaPack):
              **kwargs) -> List[Document]:
         documents = []
         try:
+            input_files = knowledge_source
             if isinstance(knowledge_source, str):
                 if os.path.isdir(knowledge_source):
-                    general_reader = SimpleDirectoryReader(
-                        input_dir=knowledge_source,
-                        file_extractor=self.extra_readers,
-                        exclude_hidden=exclude_hidden,
-                        fs=fs,
-                        recursive=recursive)
+                    # list the directory once, the reader then opens the files without walking it again
+                    input_files = _enumerate(knowledge_source, recursive,
+                                             exclude_hidden)
+                    if not input_files:
+                        raise ValueError(
+                            f'No files found in {knowledge_source}.')
                 elif os.path.isfile(knowledge_source):
-                    general_reader = SimpleDirectoryReader(
-                        input_files=[knowledge_source],
-                        file_extractor=self.extra_readers,
-                        exclude_hidden=exclude_hidden,
-                        fs=fs,
-                        recursive=recursive)
+                    input_files = [knowledge_source]
                 else:
                     raise ValueError(
                         f'file path not exists: {knowledge_source}.')
-            else:
-                general_reader = SimpleDirectoryReader(
-                    input_files=knowledge_source,
-                    file_extractor=self.extra_readers,
-                    fs=fs,
-                    exclude_hidden=exclude_hidden,
-                    recursive=recursive)
-
-            # documents = general_reader.load_data(num_workers=os.cpu_count())
-            documents = general_reader.load_data()
+            general_reader = SimpleDirectoryReader(
+                input_files=input_files,
+                file_extractor=self.extra_readers,
+                fs=fs,
+                exclude_hidden=exclude_hidden,
+                recursive=recursive)
+        except ValueError as e:
+            print(f'No valid documents, {e}')
+            return documents
+
+        # outside the try above, a bad `LOAD_DOCUMENTS_NUM_WORKERS` is raised instead of read as no documents
+        num_workers = self.get_num_workers(len(general_reader.input_files))
+        try:
+            documents = general_reader.load_data(
+                num_workers=num_workers, show_progress=False)
         except ValueError as e:
             print(f'No valid documents, {e}')
-            documents = []
         return documents
 
+    def get_num_workers(self, num_files: int) -> int:
+        """Number of processes used to parse files or split documents, 1 works in the calling process.
+
+        llama-index starts its workers with the spawn context and each of them re-runs the `__main__` script,
+        so they are only used when `LOAD_DOCUMENTS_NUM_WORKERS` is set, by scripts with a guarded entry point.
+        """
+        num_workers = os.getenv(LOAD_DOCUMENTS_NUM_WORKERS)
+        if not num_workers:
+            return 1
+        try:
+            num_workers = int(num_workers)
+        except ValueError:
+            raise ValueError(
+                f'{LOAD_DOCUMENTS_NUM_WORKERS} should be an integer, got {num_workers!r}.'
+            )
+        return max(1, min(num_files, num_workers))
+
     def set_filter(self, files: List[str]):
         retriever = self.query_engine.retriever
-        filters = [
-            MetadataFilter(key='file_name', value=os.path.basename(file))
-            for file in files
-        ]
-        retriever._filters = MetadataFilters(filters=filters)
+        retriever._filters = self._get_filters(files)
+
+    def _get_filters(self, files: List[str]) -> MetadataFilters:
+        # the same filters object is reused for the same files, whatever their order
+        file_names = sorted({os.path.basename(file) for file in files})
+        return _get_file_filters(tuple(file_names))
 
     def run(self,
             query: str,
@@ -326,14 +573,69 @@ class BaseKnowledge(BaseLlamaPack):
             ]
             return msg
 
-    def add(self, files: List[str]):
+    async def arun(self,
+                   query: str,
+                   files: List[str] = [],
+                   use_llm: bool = True,
+                   **kwargs) -> Union[str, List[str]]:
+        """Async version of `run`, embedding and llm requests of concurrent queries overlap."""
+        query_bundle = FileQueryBundle(query)
+        if isinstance(files, str):
+            files = [files]
+
+        if not self.query_engine:
+            print('No valid document. Return `Empty Response`.')
+            return 'Empty Response'
+
+        # a retriever and an engine per call, so neither concurrent queries nor `set_filter` change its filters
+        retriever = copy.copy(self.query_engine.retriever)
+        retriever._filters = None
+        if files and len(files) > 0:
+            retriever._filters = self._get_filters(files)
+        query_engine = self.get_query_engine(retriever)
+
+        nodes = await query_engine.aretrieve(query_bundle)
+        if use_llm:
+            return str(await query_engine.asynthesize(query_bundle, nodes))
+        return [
+            n.node.get_content(metadata_mode=MetadataMode.LLM) for n in nodes
+        ]
+
+    def add(self, files: List[str], batch_size: int = 100):
+        """Read files and add their documents to the knowledge base.
+
+        Args:
+            files: Path to a file, or list of file_paths.
+            batch_size: Number of nodes inserted into the index at a time, embeddings of a batch are
+                requested together.
+        """
         if isinstance(files, str):
             files = [files]
 
         try:
-            documents = self.read(files)
-            root_retriever = self.get_root_retriever(documents, use_cache=True)
-            self.query_engine = self.get_query_engine(root_retriever)
+            if self._index is None:
+                root_retriever = self.get_root_retriever(
+                    self.read(files), use_cache=True)
+                self.query_engine = self.get_query_engine(root_retriever)
+                return
+
+            # unchanged files are not read again, documents of changed files are replaced
+            documents = self._read_changed_files(self._index, files)
+            if not documents:
+                # documents of files removed from disk may still have been deleted
+                self._persist(self._index)
+                return
+
+            # insert into the live index
+            self._insert_documents(
+                self._index, documents, batch_size=batch_size)
+            self._record_files(self._index, documents)
+            self._persist(self._index)
+
+            # the default retriever reads the index directly, custom ones may hold a snapshot of it
+            if self.retriever_cls or self.query_engine is None:
+                self.query_engine = self.get_query_engine(
+                    self.get_retriever(self._index))
 
         except BaseException as e:
             print(f'add files {files} failed, detail: {e}')
@@ -1,3 +1,5 @@
+import asyncio
+from functools import partial
 from typing import Any, Callable, Dict, Optional, Sequence
 
 from llama_index.core.base.llms.types import (ChatMessage, ChatResponse,
@@ -144,14 +146,19 @@ class ModelscopeAgentLLM(LLM):
     @llm_chat_callback()
     async def achat(self, messages: Sequence[ChatMessage],
                     **kwargs: Any) -> ChatResponse:
-        return self.chat(messages, **kwargs)
+        # the wrapped model is blocking, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, partial(self.chat, messages, **kwargs))
 
     @llm_completion_callback()
     async def acomplete(self,
                         prompt: str,
                         formatted: bool = False,
                         **kwargs: Any):
-        return self.complete(prompt, formatted, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, partial(self.complete, prompt, formatted, **kwargs))
 
     @llm_chat_callback()
     async def astream_chat(self, messages: Sequence[ChatMessage],
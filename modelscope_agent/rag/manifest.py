@@ -0,0 +1,59 @@
+import hashlib
+import os
+from typing import Any, Dict, List, Optional
+
+import json
+
+MANIFEST_FNAME = 'manifest.json'
+
+# only the head of a file is hashed, mtime and size catch changes further in
+HASH_PREFIX_BYTES = 64 * 1024
+
+
+def _sha1_prefix(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read(HASH_PREFIX_BYTES)).hexdigest()
+
+
+def file_entry(path: str, doc_ids: List[str]) -> Dict[str, Any]:
+    """Manifest entry of an indexed file: its signature and the ids of the documents read from it."""
+    stat = os.stat(path)
+    return {
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha1': _sha1_prefix(path),
+        'doc_ids': doc_ids,
+    }
+
+
+def is_unchanged(path: str, entry: Dict[str, Any]) -> bool:
+    """Whether a file still matches its manifest entry."""
+    try:
+        stat = os.stat(path)
+        if (stat.st_mtime_ns != entry.get('mtime_ns')
+                or stat.st_size != entry.get('size')):
+            return False
+        return _sha1_prefix(path) == entry.get('sha1')
+    except OSError:
+        return False
+
+
+def load_manifest(cache_dir: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Manifest of the files indexed in `cache_dir`, None if the cache has none."""
+    manifest_path = os.path.join(cache_dir, MANIFEST_FNAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f'Can not load manifest {manifest_path}, detail: {e}')
+        return None
+
+
+def save_manifest(cache_dir: str, manifest: Dict[str, Dict[str,
+                                                          Any]]) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_path = os.path.join(cache_dir, MANIFEST_FNAME)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
@@ -0,0 +1,533 @@
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import fsspec
+import json
+import numpy as np
+from fsspec.implementations.local import LocalFileSystem
+from llama_index.core.indices.query.embedding_utils import \
+    get_top_k_mmr_embeddings
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (MetadataFilter,
+                                                  MetadataFilters,
+                                                  VectorStore,
+                                                  VectorStoreQuery,
+                                                  VectorStoreQueryMode,
+                                                  VectorStoreQueryResult)
+from modelscope_agent.rag import _simvec_numba
+
+DEFAULT_PERSIST_DIR = './storage'
+DEFAULT_VECTOR_STORE = 'default'
+DEFAULT_PERSIST_FNAME = 'vector_store.json'
+NAMESPACE_SEP = '__'
+DEFAULT_PERSIST_PATH = os.path.join(
+    DEFAULT_PERSIST_DIR,
+    f'{DEFAULT_VECTOR_STORE}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}')
+
+SUPPORTED_QUANTIZATION = [None, 'int8']
+
+# metadata keys indexed as nodes are added, `BaseKnowledge.set_filter` filters on file names
+INDEXED_METADATA_KEYS = ['file_name']
+
+# number of filter row masks kept per store, the same file filter is usually reused across queries
+_FILTER_CACHE_SIZE = 128
+
+# rows dequantized at once when scoring int8 embeddings, bounds the temporary float32 copy
+_SCORE_BLOCK_ROWS = 4096
+
+
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+    """L2 normalize a vector or the rows of a matrix, zero vectors are left as they are."""
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (embeddings / norms).astype(np.float32, copy=False)
+
+
+def _quantize(embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric int8 quantization with one scale per row."""
+    scales = np.abs(embeddings).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.round(embeddings / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _embedding_path(persist_path: str) -> str:
+    return os.path.splitext(persist_path)[0] + '.npy'
+
+
+def _scale_path(persist_path: str) -> str:
+    return os.path.splitext(persist_path)[0] + '.scales.npy'
+
+
+def _save_array(fs: fsspec.AbstractFileSystem, path: str,
+                array: np.ndarray) -> None:
+    # the current file may still be memory mapped by a store, write aside then replace it
+    tmp_path = f'{path}.tmp'
+    with fs.open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    fs.mv(tmp_path, path)
+
+
+def _load_array(fs: fsspec.AbstractFileSystem, path: str) -> np.ndarray:
+    if isinstance(fs, LocalFileSystem):
+        return np.load(path, mmap_mode='r')
+    with fs.open(path, 'rb') as f:
+        return np.load(f)
+
+
+def _append_rows(buffer: Optional[np.ndarray], size: int,
+                 rows: np.ndarray) -> np.ndarray:
+    """Write rows after the first `size` rows of a buffer, growing it by doubling when it is full.
+
+    A read only buffer, i.e. the memory mapped matrix of a loaded store, is copied into a new one first.
+    """
+    required = size + len(rows)
+    if (buffer is None or len(buffer) < required
+            or not buffer.flags.writeable):
+        capacity = max(required, 2 * size)
+        grown = np.empty((capacity, ) + rows.shape[1:], dtype=rows.dtype)
+        if size:
+            grown[:size] = buffer[:size]
+        buffer = grown
+    buffer[size:required] = rows
+    return buffer
+
+
+def _keep_rows(buffer: np.ndarray, size: int,
+               kept: np.ndarray) -> np.ndarray:
+    """Move the kept rows to the front of a buffer, copying it when it is read only."""
+    if not buffer.flags.writeable:
+        return np.ascontiguousarray(buffer[:size][kept])
+    buffer[:len(kept)] = buffer[:size][kept]
+    return buffer
+
+
+def _match_filter(metadata: Dict[str, Any],
+                  metadata_filter: MetadataFilter) -> bool:
+    if metadata_filter.key not in metadata:
+        return False
+    value = metadata[metadata_filter.key]
+    operator = getattr(metadata_filter.operator, 'value',
+                       metadata_filter.operator)
+    if operator == '==':
+        return value == metadata_filter.value
+    elif operator == '!=':
+        return value != metadata_filter.value
+    elif operator == '>':
+        return value > metadata_filter.value
+    elif operator == '>=':
+        return value >= metadata_filter.value
+    elif operator == '<':
+        return value < metadata_filter.value
+    elif operator == '<=':
+        return value <= metadata_filter.value
+    elif operator == 'in':
+        return value in metadata_filter.value
+    elif operator == 'nin':
+        return value not in metadata_filter.value
+    elif operator in ('contains', 'text_match'):
+        return metadata_filter.value in value
+    raise ValueError(f'Unsupported filter operator: {operator}')
+
+
+def _index_values(index: Dict[Any, List[int]],
+                  key: str,
+                  metadata: List[Dict[str, Any]],
+                  start: int = 0) -> None:
+    for i, row_metadata in enumerate(metadata, start):
+        if key not in row_metadata:
+            continue
+        try:
+            index.setdefault(row_metadata[key], []).append(i)
+        except TypeError:
+            # unhashable values are only reachable through the row by row match
+            pass
+
+
+def _is_match_all(metadata_filters: MetadataFilters) -> bool:
+    condition = getattr(metadata_filters, 'condition', None)
+    return str(getattr(condition, 'value', condition)).lower() != 'or'
+
+
+class NumpyVectorStore(VectorStore):
+    """ Vector store keeping all embeddings in one contiguous float32 matrix.
+
+    Rows are L2 normalized on insert, so the cosine similarity of a query against the whole store is a
+    single matrix-vector product instead of a python loop over an embedding dict.
+
+    Embeddings are persisted as a `.npy` file next to a small json file holding node ids and metadata,
+    and are loaded back with `mmap_mode='r'`: a large cached index is paged in on demand instead of
+    being parsed from json on every start. Files written by llama-index `SimpleVectorStore` can still
+    be loaded, they are converted the next time the store is persisted.
+
+    With `quantization='int8'` every row is stored as int8 codes plus one float32 scale, a quarter of the
+    memory and disk size of float32, at the cost of a small loss of precision in the similarities.
+
+    Args:
+        fs: The file system used to persist the store, defaults to the local file system.
+        quantization: How embeddings are stored, None for float32 or `int8`.
+    """
+
+    stores_text: bool = False
+    is_embedding_query: bool = True
+
+    def __init__(self,
+                 fs: Optional[fsspec.AbstractFileSystem] = None,
+                 quantization: Optional[str] = None) -> None:
+        if quantization not in SUPPORTED_QUANTIZATION:
+            raise ValueError(
+                f'quantization {quantization} is not supported.')
+        self._fs = fs or fsspec.filesystem('file')
+        self._quantization = quantization
+        self._set_rows([], [], [], None)
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def __len__(self) -> int:
+        self._compact()
+        return len(self._node_ids)
+
+    def _set_rows(self,
+                  node_ids: List[str],
+                  ref_doc_ids: List[Optional[str]],
+                  metadata: List[Dict[str, Any]],
+                  matrix: Optional[np.ndarray],
+                  scales: Optional[np.ndarray] = None) -> None:
+        self._node_ids = node_ids
+        self._ref_doc_ids = ref_doc_ids
+        self._metadata = metadata
+        # float32 embeddings, or int8 codes when scales are set. Only the first `len(self)` rows are in
+        # use, the rest is room for `add` to grow into.
+        self._buffer = matrix if node_ids else None
+        self._scale_buffer = scales if node_ids else None
+        self._id_to_row = {node_id: i for i, node_id in enumerate(node_ids)}
+        self._doc_rows: Dict[Optional[str], List[int]] = {}
+        for i, ref_doc_id in enumerate(ref_doc_ids):
+            self._doc_rows.setdefault(ref_doc_id, []).append(i)
+        # rows of deleted documents, dropped together by the next `_compact`
+        self._deleted_rows: List[int] = []
+        # built lazily from the metadata, both are invalidated whenever rows move. `add` keeps the
+        # inverted indexes up to date.
+        self._value_index: Dict[str, Dict[Any, List[int]]] = {}
+        self._filter_rows: Dict[str, np.ndarray] = {}
+        self._set_views()
+
+    def _set_views(self) -> None:
+        size = len(self._node_ids)
+        self._matrix = None
+        self._scales = None
+        if size:
+            self._matrix = self._buffer[:size]
+            if self._scale_buffer is not None:
+                self._scales = self._scale_buffer[:size]
+
+    def _compact(self) -> None:
+        """Drop the rows of the documents deleted since the last call, in a single pass over the store."""
+        if not self._deleted_rows:
+            return
+        size = len(self._node_ids)
+        keep = np.ones(size, dtype=bool)
+        keep[self._deleted_rows] = False
+        kept = np.flatnonzero(keep)
+        matrix = None
+        scales = None
+        if len(kept):
+            matrix = _keep_rows(self._buffer, size, kept)
+            if self._scale_buffer is not None:
+                scales = _keep_rows(self._scale_buffer, size, kept)
+        self._set_rows([self._node_ids[i] for i in kept],
+                       [self._ref_doc_ids[i] for i in kept],
+                       [self._metadata[i] for i in kept], matrix, scales)
+
+    def _embeddings(self, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Float32 embeddings of the given rows, all rows if None."""
+        matrix = self._matrix if rows is None else self._matrix[rows]
+        if self._scales is None:
+            return matrix
+        scales = self._scales if rows is None else self._scales[rows]
+        return matrix.astype(np.float32) * scales[:, None]
+
+    def _scores(self, query_embedding: np.ndarray,
+                rows: Optional[np.ndarray]) -> np.ndarray:
+        """Cosine similarities of the query against the given rows, all rows if None."""
+        if _simvec_numba.NUMBA_AVAILABLE:
+            if self._scales is not None:
+                if rows is None:
+                    rows = np.arange(len(self._node_ids))
+                return _simvec_numba.cosine_scores_int8(
+                    query_embedding, self._matrix, self._scales, rows)
+            if rows is not None:
+                return _simvec_numba.cosine_scores(query_embedding,
+                                                   self._matrix, rows)
+        matrix = self._matrix if rows is None else self._matrix[rows]
+        if self._scales is None:
+            return matrix @ query_embedding
+        scales = self._scales if rows is None else self._scales[rows]
+        scores = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), _SCORE_BLOCK_ROWS):
+            block = matrix[start:start + _SCORE_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(
+                np.float32) @ query_embedding
+        return scores * scales
+
+    def get(self, text_id: str) -> List[float]:
+        """Get the normalized embedding of a node."""
+        self._compact()
+        row = np.asarray([self._id_to_row[text_id]])
+        return self._embeddings(row)[0].tolist()
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        """Add nodes with embedding to the store, a node added again replaces its previous row."""
+        if not nodes:
+            return []
+        self._deleted_rows.extend(self._id_to_row[node.node_id]
+                                  for node in nodes
+                                  if node.node_id in self._id_to_row)
+        self._compact()
+
+        start = len(self._node_ids)
+        metadata = [dict(node.metadata) for node in nodes]
+        embeddings = _normalize(
+            np.asarray([node.get_embedding() for node in nodes],
+                       dtype=np.float32))
+        if self._quantization == 'int8':
+            embeddings, scales = _quantize(embeddings)
+            self._scale_buffer = _append_rows(self._scale_buffer, start,
+                                              scales)
+        # amortized growth, a batch does not copy the rows already in the store
+        self._buffer = _append_rows(self._buffer, start, embeddings)
+        for row, node in enumerate(nodes, start):
+            self._node_ids.append(node.node_id)
+            self._ref_doc_ids.append(node.ref_doc_id)
+            self._id_to_row[node.node_id] = row
+            self._doc_rows.setdefault(node.ref_doc_id, []).append(row)
+        self._metadata.extend(metadata)
+        self._set_views()
+
+        # rows are only appended, the inverted indexes stay valid and are extended
+        for key, index in self._value_index.items():
+            _index_values(index, key, metadata, start)
+        for key in INDEXED_METADATA_KEYS:
+            self._rows_by_value(key)
+        self._filter_rows = {}
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Delete the nodes of a document.
+
+        The rows are dropped on the next read or write of the store, so deleting many documents, e.g. the
+        pages of a changed file, compacts the matrix once. `VectorStoreIndex.delete_ref_doc` also passes
+        every node id of the document, they are not document ids and return at once.
+        """
+        rows = self._doc_rows.pop(ref_doc_id, None)
+        if rows:
+            self._deleted_rows.extend(rows)
+
+    def _rows_by_value(self, key: str) -> Dict[Any, List[int]]:
+        """Inverted index from the hashable values of a metadata key to the rows holding them."""
+        index = self._value_index.get(key)
+        if index is None:
+            index = {}
+            _index_values(index, key, self._metadata)
+            self._value_index[key] = index
+        return index
+
+    def _filter_mask(self, metadata_filters: MetadataFilters) -> np.ndarray:
+        """Boolean mask of the rows matching the filters.
+
+        `==` and `in` filters are answered from the inverted index of their key, other operators
+        fall back to matching the metadata row by row.
+        """
+        if not metadata_filters.filters:
+            return np.ones(len(self._node_ids), dtype=bool)
+        match_all = _is_match_all(metadata_filters)
+        mask = np.full(len(self._node_ids), match_all)
+        for metadata_filter in metadata_filters.filters:
+            if isinstance(metadata_filter, MetadataFilters):
+                matched = self._filter_mask(metadata_filter)
+            else:
+                matched = self._match_filter_mask(metadata_filter)
+            if match_all:
+                mask &= matched
+            else:
+                mask |= matched
+        return mask
+
+    def _match_filter_mask(self,
+                           metadata_filter: MetadataFilter) -> np.ndarray:
+        operator = getattr(metadata_filter.operator, 'value',
+                           metadata_filter.operator)
+        if operator in ('==', 'in'):
+            values = metadata_filter.value
+            if operator == '==' or not isinstance(values, (list, tuple, set)):
+                values = [values]
+            try:
+                index = self._rows_by_value(metadata_filter.key)
+                rows = [i for value in values for i in index.get(value, [])]
+            except TypeError:
+                rows = None
+            if rows is not None:
+                mask = np.zeros(len(self._node_ids), dtype=bool)
+                mask[rows] = True
+                return mask
+        return np.fromiter(
+            (_match_filter(metadata, metadata_filter)
+             for metadata in self._metadata),
+            dtype=bool,
+            count=len(self._metadata))
+
+    def _filtered_rows(self, metadata_filters: MetadataFilters) -> np.ndarray:
+        """Rows matching the filters, cached until the rows of the store change."""
+        key = metadata_filters.json()
+        rows = self._filter_rows.get(key)
+        if rows is None:
+            if len(self._filter_rows) >= _FILTER_CACHE_SIZE:
+                self._filter_rows.clear()
+            rows = np.flatnonzero(self._filter_mask(metadata_filters))
+            self._filter_rows[key] = rows
+        return rows
+
+    def _candidate_rows(self,
+                        query: VectorStoreQuery) -> Optional[np.ndarray]:
+        """Rows allowed by the node ids, doc ids and metadata filters of the query, None for all rows."""
+        if (query.node_ids is None and query.doc_ids is None
+                and query.filters is None):
+            return None
+
+        rows = np.arange(len(self._node_ids))
+        if query.filters is not None:
+            rows = self._filtered_rows(query.filters)
+        if query.node_ids is not None:
+            node_ids = set(query.node_ids)
+            rows = [i for i in rows if self._node_ids[i] in node_ids]
+        if query.doc_ids is not None:
+            doc_ids = set(query.doc_ids)
+            rows = [i for i in rows if self._ref_doc_ids[i] in doc_ids]
+        return np.asarray(rows, dtype=np.int64)
+
+    def query(self, query: VectorStoreQuery,
+              **kwargs: Any) -> VectorStoreQueryResult:
+        """Get the nodes most similar to the query embedding."""
+        if query.mode not in (VectorStoreQueryMode.DEFAULT,
+                              VectorStoreQueryMode.MMR):
+            raise ValueError(f'Invalid query mode: {query.mode}')
+        self._compact()
+        if self._matrix is None or query.query_embedding is None:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        rows = self._candidate_rows(query)
+        if rows is not None and len(rows) == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        query_embedding = _normalize(
+            np.asarray(query.query_embedding, dtype=np.float32))
+        if query.mode == VectorStoreQueryMode.MMR:
+            embeddings = self._embeddings(rows)
+            candidate_ids = list(range(len(embeddings)))
+            similarities, top = get_top_k_mmr_embeddings(
+                query_embedding.tolist(),
+                embeddings.tolist(),
+                similarity_top_k=query.similarity_top_k,
+                embedding_ids=candidate_ids,
+                mmr_threshold=kwargs.get('mmr_threshold',
+                                         query.mmr_threshold))
+            top = np.asarray(top, dtype=np.int64)
+        else:
+            top, similarities = _simvec_numba.topk(
+                self._scores(query_embedding, rows), query.similarity_top_k)
+            similarities = similarities.tolist()
+
+        if rows is not None:
+            top = rows[top]
+        return VectorStoreQueryResult(
+            similarities=similarities,
+            ids=[self._node_ids[i] for i in top])
+
+    def persist(self,
+                persist_path: str = DEFAULT_PERSIST_PATH,
+                fs: Optional[fsspec.AbstractFileSystem] = None) -> None:
+        """Persist the node ids and metadata as json and the embeddings as `.npy` next to it."""
+        fs = fs or self._fs
+        self._compact()
+        dirpath = os.path.dirname(persist_path)
+        if dirpath and not fs.exists(dirpath):
+            fs.makedirs(dirpath)
+
+        embedding_path = _embedding_path(persist_path)
+        matrix = self._matrix
+        if matrix is None:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        _save_array(fs, embedding_path, matrix)
+
+        data = {
+            'node_ids': self._node_ids,
+            'ref_doc_ids': self._ref_doc_ids,
+            'metadata': self._metadata,
+            'embedding_file': os.path.basename(embedding_path),
+        }
+        if self._scales is not None:
+            scale_path = _scale_path(persist_path)
+            _save_array(fs, scale_path, self._scales)
+            data['quantization'] = 'int8'
+            data['scale_file'] = os.path.basename(scale_path)
+        with fs.open(persist_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, default=str)
+
+    @classmethod
+    def from_persist_path(
+            cls,
+            persist_path: str,
+            fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> 'NumpyVectorStore':
+        """Load a store persisted by `NumpyVectorStore` or llama-index `SimpleVectorStore`."""
+        fs = fs or fsspec.filesystem('file')
+        if not fs.exists(persist_path):
+            raise ValueError(
+                f'No existing vector store found at {persist_path}.')
+        with fs.open(persist_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        store = cls(fs=fs)
+        if 'embedding_dict' in data:
+            # written by SimpleVectorStore, the embeddings are inlined in the json file
+            embedding_dict = data['embedding_dict']
+            ref_doc_ids = data.get('text_id_to_ref_doc_id', {})
+            metadata = data.get('metadata_dict') or {}
+            node_ids = list(embedding_dict)
+            matrix = None
+            if node_ids:
+                matrix = _normalize(
+                    np.asarray([embedding_dict[i] for i in node_ids],
+                               dtype=np.float32))
+            store._set_rows(node_ids, [ref_doc_ids.get(i) for i in node_ids],
+                            [metadata.get(i, {}) for i in node_ids], matrix)
+            return store
+
+        store._quantization = data.get('quantization')
+        node_ids = data['node_ids']
+        matrix = None
+        scales = None
+        if node_ids:
+            dirpath = os.path.dirname(persist_path)
+            matrix = _load_array(
+                fs, os.path.join(dirpath, data['embedding_file']))
+            if 'scale_file' in data:
+                scales = _load_array(
+                    fs, os.path.join(dirpath, data['scale_file']))
+        store._set_rows(node_ids, data['ref_doc_ids'], data['metadata'],
+                        matrix, scales)
+        return store
+
+    @classmethod
+    def from_persist_dir(
+            cls,
+            persist_dir: str = DEFAULT_PERSIST_DIR,
+            namespace: str = DEFAULT_VECTOR_STORE,
+            fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> 'NumpyVectorStore':
+        """Load the store of a namespace from a persist directory."""
+        persist_path = os.path.join(
+            persist_dir, f'{namespace}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}')
+        return cls.from_persist_path(persist_path, fs=fs)
@@ -1,8 +1,15 @@
+from typing import List
+
+import json
 from modelscope_agent.tools.base import register_tool
 
+from modelscope.outputs import OutputKeys
 from modelscope.utils.constant import Tasks
 from .pipeline_tool import ModelscopePipelineTool
 
+# the csanmt translation pipeline translates every sentence separated by this mark in one batch
+SENT_SPLIT = '<SENT_SPLIT>'
+
 
 @register_tool('text-translation-en2zh')
 class TranslationEn2ZhTool(ModelscopePipelineTool):
@@ -20,5 +27,21 @@ class TranslationEn2ZhTool(ModelscopePipelineTool):
 
     def call(self, params: str, **kwargs) -> str:
         result = super().call(params, **kwargs)
+        if self.use_local:
+            # the local pipeline output is dumped to json, without the `Data` wrapper of the remote api
+            return json.loads(result)[OutputKeys.TRANSLATION]
         zh = result['Data']['translation']
         return zh
+
+    def batch_call(self, texts: List[str], **kwargs) -> List[str]:
+        """Translate several texts with a single pipeline call instead of one call per text."""
+        if not texts:
+            return []
+        params = json.dumps({'input': SENT_SPLIT.join(texts)},
+                            ensure_ascii=False)
+        translations = self.call(params, **kwargs).split(SENT_SPLIT)
+        if len(translations) != len(texts):
+            raise ValueError(
+                f'Expect {len(texts)} translations, got {len(translations)}.'
+            )
+        return [translation.strip() for translation in translations]
@@ -0,0 +1,34 @@
+import dashscope
+import httpx
+from modelscope_agent.rag.emb import DASHSCOPE_MAX_BATCH_SIZE, DashscopeEmbedding
+
+
+def test_dashscope_embedding_batches_and_orders(monkeypatch):
+    requests = []
+
+    def post(self, url, headers=None, json=None, **kwargs):
+        requests.append((headers, json['input']['texts']))
+        embeddings = [{
+            'text_index': i,
+            'embedding': [float(text)]
+        } for i, text in enumerate(json['input']['texts'])]
+        # the api does not promise to answer in input order
+        return httpx.Response(
+            200, json={'output': {
+                'embeddings': embeddings[::-1]
+            }})
+
+    monkeypatch.setattr(httpx.Client, 'post', post)
+    monkeypatch.setattr(dashscope, 'api_key', 'sk-test')
+
+    texts = [str(i) for i in range(DASHSCOPE_MAX_BATCH_SIZE + 5)]
+    embedding = DashscopeEmbedding(embed_batch_size=100, workspace='ws-test')
+    expected = [[float(text)] for text in texts]
+    assert embedding.get_text_embedding_batch(texts) == expected
+
+    assert [len(batch) for _, batch in requests] == [
+        DASHSCOPE_MAX_BATCH_SIZE, 5
+    ]
+    headers = requests[0][0]
+    assert headers['Authorization'] == 'Bearer sk-test'
+    assert headers['X-DashScope-WorkSpace'] == 'ws-test'
@@ -0,0 +1,154 @@
+import asyncio
+import os
+import threading
+from functools import partial
+
+import pytest
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+from modelscope_agent.llm.base import BaseChatModel
+from modelscope_agent.rag.knowledge import BaseKnowledge, _enumerate
+from modelscope_agent.rag.manifest import load_manifest
+
+
+def _write(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return os.path.abspath(path)
+
+
+def _knowledge(files, cache_dir, use_cache=True):
+    return BaseKnowledge(
+        files,
+        cache_dir=cache_dir,
+        llm=MockLLM(),
+        emb=partial(MockEmbedding, embed_dim=8),
+        use_cache=use_cache)
+
+
+def _indexed_doc_ids(knowledge):
+    return set(knowledge._index.docstore.get_all_ref_doc_info() or {})
+
+
+class _ThreadRecordingChatModel(BaseChatModel):
+
+    def __init__(self):
+        super().__init__('stub', 'stub')
+        self.threads = []
+
+    def _chat_stream(self, messages, stop=None, **kwargs):
+        yield self._chat_no_stream(messages, stop, **kwargs)
+
+    def _chat_no_stream(self, messages, stop=None, **kwargs):
+        self.threads.append(threading.get_ident())
+        return 'answer'
+
+
+@pytest.fixture
+def docs(tmpdir):
+    docs_dir = tmpdir.mkdir('docs')
+    return {
+        'a': _write(str(docs_dir.join('a.txt')), 'modelscope agent'),
+        'b': _write(str(docs_dir.join('b.txt')), 'git lfs upload'),
+    }
+
+
+def test_knowledge_cache_reads_changed_files(tmpdir, docs):
+    cache_dir = str(tmpdir.join('cache'))
+    knowledge = _knowledge(list(docs.values()), cache_dir)
+    manifest = load_manifest(cache_dir)
+    assert set(manifest) == set(docs.values())
+
+    _write(docs['a'], 'modelscope agent, changed')
+    knowledge = _knowledge(list(docs.values()), cache_dir)
+    new_manifest = load_manifest(cache_dir)
+    # only the changed file was re-read, its old documents are gone
+    assert new_manifest[docs['b']] == manifest[docs['b']]
+    assert not set(manifest[docs['a']]['doc_ids']) & _indexed_doc_ids(
+        knowledge)
+    assert set(new_manifest[docs['a']]['doc_ids']) <= _indexed_doc_ids(
+        knowledge)
+
+
+def test_knowledge_cache_drops_deleted_files(tmpdir, docs):
+    cache_dir = str(tmpdir.join('cache'))
+    _knowledge(list(docs.values()), cache_dir)
+    deleted_ids = set(load_manifest(cache_dir)[docs['b']]['doc_ids'])
+
+    os.remove(docs['b'])
+    knowledge = _knowledge([docs['a']], cache_dir)
+    assert set(load_manifest(cache_dir)) == {docs['a']}
+    assert not deleted_ids & _indexed_doc_ids(knowledge)
+
+
+def test_knowledge_add_unchanged_file(tmpdir, docs):
+    cache_dir = str(tmpdir.join('cache'))
+    knowledge = _knowledge([docs['a']], cache_dir)
+    indexed_ids = _indexed_doc_ids(knowledge)
+
+    knowledge.add([docs['a']])
+    assert not knowledge._dirty
+    assert _indexed_doc_ids(knowledge) == indexed_ids
+
+    # without a manifest entry the file is read again, its documents are skipped as already indexed
+    knowledge._manifest.clear()
+    knowledge.add([docs['a']])
+    assert _indexed_doc_ids(knowledge) == indexed_ids
+    assert set(knowledge._manifest[docs['a']]['doc_ids']) == indexed_ids
+
+    # so a later change still replaces them
+    _write(docs['a'], 'modelscope agent, changed')
+    knowledge.add([docs['a']])
+    assert not indexed_ids & _indexed_doc_ids(knowledge)
+    assert set(knowledge._manifest[docs['a']]['doc_ids']) == (
+        _indexed_doc_ids(knowledge))
+
+
+def test_knowledge_without_documents_keeps_cache(tmpdir, docs):
+    cache_dir = str(tmpdir.join('cache'))
+    _knowledge(list(docs.values()), cache_dir)
+    manifest = load_manifest(cache_dir)
+
+    # an empty index is not persisted, neither is a manifest that would not describe the cache
+    _knowledge([], cache_dir, use_cache=False)
+    assert load_manifest(cache_dir) == manifest
+
+
+def test_enumerate_lists_every_visible_file(tmpdir):
+    report = _write(str(tmpdir.join('Report.PDF')), '')
+    config = _write(str(tmpdir.join('config.json')), '{}')
+    _write(str(tmpdir.join('.hidden.txt')), '')
+
+    # files without a dedicated reader are left to the reader's plain text fallback
+    files = _enumerate(str(tmpdir), False, True)
+    assert [os.path.abspath(file) for file in files] == sorted(
+        [report, config])
+
+
+def test_knowledge_arun_filters_concurrent_queries(tmpdir, docs):
+    chat_model = _ThreadRecordingChatModel()
+    knowledge = BaseKnowledge(
+        list(docs.values()),
+        cache_dir=str(tmpdir.join('cache')),
+        llm=chat_model,
+        emb=partial(MockEmbedding, embed_dim=8))
+    # left on the shared retriever by a sync query, must not leak into arun
+    knowledge.set_filter([docs['b']])
+
+    async def query_all():
+        return await asyncio.gather(
+            knowledge.arun('agent', files=[docs['a']], use_llm=False),
+            knowledge.arun('lfs', files=[docs['b']], use_llm=False),
+            knowledge.arun('agent', use_llm=False),
+            knowledge.arun('agent', files=[docs['a']]))
+
+    only_a, only_b, unfiltered, answer = asyncio.run(query_all())
+    assert only_a and all('modelscope agent' in text for text in only_a)
+    assert only_b and all('git lfs' in text for text in only_b)
+    assert any('modelscope agent' in text for text in unfiltered)
+    assert any('git lfs' in text for text in unfiltered)
+
+    # the blocking chat model is called off the event loop
+    assert answer == 'answer'
+    assert chat_model.threads
+    assert threading.get_ident() not in chat_model.threads
@@ -0,0 +1,34 @@
+import os
+
+from modelscope_agent.rag.manifest import (file_entry, is_unchanged,
+                                           load_manifest, save_manifest)
+
+
+def test_manifest_detects_changes(tmpdir):
+    path = str(tmpdir.join('qa.txt'))
+    with open(path, 'w') as f:
+        f.write('question')
+
+    entry = file_entry(path, ['doc_a'])
+    assert is_unchanged(path, entry)
+
+    with open(path, 'w') as f:
+        f.write('answer!!')
+    os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+    # same size and mtime, only the content hash tells the difference
+    assert not is_unchanged(path, entry)
+
+    os.remove(path)
+    assert not is_unchanged(path, entry)
+
+
+def test_manifest_save_and_load(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    assert load_manifest(cache_dir) is None
+
+    path = str(tmpdir.join('qa.txt'))
+    with open(path, 'w') as f:
+        f.write('question')
+    manifest = {path: file_entry(path, ['doc_a', 'doc_b'])}
+    save_manifest(cache_dir, manifest)
+    assert load_manifest(cache_dir) == manifest
@@ -0,0 +1,167 @@
+import numpy as np
+import pytest
+from llama_index.core.schema import (NodeRelationship, RelatedNodeInfo,
+                                     TextNode)
+from llama_index.core.vector_stores.types import (FilterCondition,
+                                                  MetadataFilter,
+                                                  MetadataFilters,
+                                                  VectorStoreQuery)
+from modelscope_agent.rag.vector_store import NumpyVectorStore
+
+
+def _node(node_id, embedding, file_name, ref_doc_id):
+    node = TextNode(
+        id_=node_id,
+        text=node_id,
+        embedding=embedding,
+        metadata={'file_name': file_name})
+    node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(
+        node_id=ref_doc_id)
+    return node
+
+
+@pytest.fixture
+def vector_store():
+    store = NumpyVectorStore()
+    store.add([
+        _node('a', [1.0, 0.0, 0.0], 'a.txt', 'doc_a'),
+        _node('b', [0.0, 2.0, 0.0], 'b.txt', 'doc_b'),
+        _node('c', [0.6, 0.8, 0.0], 'b.txt', 'doc_b'),
+    ])
+    return store
+
+
+def test_query_top_k(vector_store):
+    result = vector_store.query(
+        VectorStoreQuery(query_embedding=[0.0, 1.0, 0.0], similarity_top_k=2))
+    assert result.ids == ['b', 'c']
+    assert result.similarities == pytest.approx([1.0, 0.8])
+
+
+def test_query_with_filters(vector_store):
+    filters = MetadataFilters(
+        filters=[MetadataFilter(key='file_name', value='a.txt')])
+    result = vector_store.query(
+        VectorStoreQuery(
+            query_embedding=[0.0, 1.0, 0.0],
+            similarity_top_k=2,
+            filters=filters))
+    assert result.ids == ['a']
+
+
+def test_query_with_or_filters(vector_store):
+    filters = MetadataFilters(
+        filters=[
+            MetadataFilter(key='file_name', value='a.txt'),
+            MetadataFilter(key='file_name', value='b.txt'),
+        ],
+        condition=FilterCondition.OR)
+    query = VectorStoreQuery(
+        query_embedding=[1.0, 0.0, 0.0], similarity_top_k=3, filters=filters)
+    assert vector_store.query(query).ids == ['a', 'c', 'b']
+
+    # the cached rows of a filter are dropped once the store changes
+    vector_store.delete('doc_a')
+    assert vector_store.query(query).ids == ['c', 'b']
+
+
+def test_file_name_index_follows_add(vector_store):
+    filters = MetadataFilters(
+        filters=[MetadataFilter(key='file_name', value='d.txt')])
+    query = VectorStoreQuery(
+        query_embedding=[0.0, 0.0, 1.0], similarity_top_k=2, filters=filters)
+    assert vector_store.query(query).ids == []
+
+    vector_store.add([_node('d', [0.0, 0.0, 1.0], 'd.txt', 'doc_d')])
+    assert vector_store._value_index['file_name']['d.txt'] == [3]
+    assert vector_store.query(query).ids == ['d']
+
+
+def test_delete(vector_store):
+    vector_store.delete('doc_b')
+    assert len(vector_store) == 1
+    result = vector_store.query(
+        VectorStoreQuery(query_embedding=[0.0, 1.0, 0.0], similarity_top_k=2))
+    assert result.ids == ['a']
+
+
+def test_delete_compacts_once(vector_store):
+    # node ids passed by `delete_ref_doc` are not document ids
+    vector_store.delete('b')
+    assert not vector_store._deleted_rows
+
+    vector_store.delete('doc_a')
+    vector_store.delete('doc_b')
+    assert sorted(vector_store._deleted_rows) == [0, 1, 2]
+    assert len(vector_store) == 0
+    assert vector_store._matrix is None
+
+    vector_store.add([_node('d', [0.0, 0.0, 1.0], 'd.txt', 'doc_d')])
+    vector_store.add([_node('e', [0.0, 1.0, 0.0], 'e.txt', 'doc_e')])
+    # the matrix grows into spare capacity instead of being copied per add
+    assert len(vector_store._buffer) >= len(vector_store) == 2
+    result = vector_store.query(
+        VectorStoreQuery(query_embedding=[0.0, 1.0, 0.0], similarity_top_k=1))
+    assert result.ids == ['e']
+
+
+def test_persist_and_load(vector_store, tmpdir):
+    persist_dir = str(tmpdir)
+    vector_store.persist(f'{persist_dir}/default__vector_store.json')
+
+    loaded = NumpyVectorStore.from_persist_dir(persist_dir)
+    assert isinstance(loaded._matrix, np.memmap)
+    result = loaded.query(
+        VectorStoreQuery(query_embedding=[0.0, 1.0, 0.0], similarity_top_k=1))
+    assert result.ids == ['b']
+
+    # adding to a loaded store must not write into the memory mapped file
+    loaded.add([_node('d', [0.0, 0.0, 1.0], 'd.txt', 'doc_d')])
+    loaded.persist(f'{persist_dir}/default__vector_store.json')
+    assert len(NumpyVectorStore.from_persist_dir(persist_dir)) == 4
+
+
+def test_int8_quantization(tmpdir):
+    store = NumpyVectorStore(quantization='int8')
+    store.add([
+        _node('a', [1.0, 0.0, 0.0], 'a.txt', 'doc_a'),
+        _node('b', [0.0, 2.0, 0.0], 'b.txt', 'doc_b'),
+        _node('c', [0.6, 0.8, 0.0], 'b.txt', 'doc_b'),
+    ])
+    assert store._matrix.dtype == np.int8
+
+    persist_dir = str(tmpdir)
+    store.persist(f'{persist_dir}/default__vector_store.json')
+    loaded = NumpyVectorStore.from_persist_dir(persist_dir)
+    result = loaded.query(
+        VectorStoreQuery(query_embedding=[0.0, 1.0, 0.0], similarity_top_k=2))
+    assert result.ids == ['b', 'c']
+    assert result.similarities == pytest.approx([1.0, 0.8], abs=1e-2)
+
+
+def test_numba_cosine_scores():
+    pytest.importorskip('numba')
+    from modelscope_agent.rag import _simvec_numba
+
+    matrix = np.random.rand(16, 8).astype(np.float32)
+    query = np.random.rand(8).astype(np.float32)
+    rows = np.asarray([3, 0, 11], dtype=np.int64)
+    np.testing.assert_allclose(
+        _simvec_numba.cosine_scores(query, matrix, rows),
+        matrix[rows] @ query,
+        rtol=1e-5)
+
+
+def test_numba_cosine_scores_int8():
+    pytest.importorskip('numba')
+    from modelscope_agent.rag import _simvec_numba
+
+    codes = np.random.randint(-127, 128, size=(16, 8)).astype(np.int8)
+    scales = np.random.rand(16).astype(np.float32)
+    query = np.random.rand(8).astype(np.float32)
+    rows = np.asarray([3, 0, 11], dtype=np.int64)
+    expected = (codes[rows].astype(np.float32) @ query) * scales[rows]
+    np.testing.assert_allclose(
+        _simvec_numba.cosine_scores_int8(query, codes, scales, rows),
+        expected,
+        rtol=1e-5)
@@ -62,3 +62,34 @@ def test_modelscope_text_ie():
     txt_ie = TextInfoExtractTool()
     res = txt_ie.call(kwargs)
     assert isinstance(res, str)
+
+
+@pytest.mark.skipif(IS_FORKED_PR, reason='only run modelscope-agent main repo')
+def test_modelscope_translation_en2zh_batch():
+    from modelscope_agent.tools.modelscope_tools.translation_en2zh_tool import TranslationEn2ZhTool
+    translation = TranslationEn2ZhTool()
+    res = translation.batch_call(['Hello.', 'How are you?'])
+    assert len(res) == 2
+    assert all(isinstance(r, str) for r in res)
+
+
+def test_modelscope_translation_en2zh_batch_local():
+    from modelscope_agent.tools.modelscope_tools.translation_en2zh_tool import TranslationEn2ZhTool
+    cfg = {
+        'text-translation-en2zh': {
+            'is_remote_tool': False,
+        }
+    }
+    translation = TranslationEn2ZhTool(cfg)
+    inputs = []
+
+    def pipeline(input, **kwargs):
+        inputs.append(input)
+        return {'translation': '你好。<SENT_SPLIT> 你好吗？'}
+
+    # stands in for the csanmt model, which needs tensorflow
+    translation.pipeline = pipeline
+    translation.is_initialized = True
+    res = translation.batch_call(['Hello.', 'How are you?'])
+    assert inputs == ['Hello.<SENT_SPLIT>How are you?']
+    assert res == ['你好。', '你好吗？']